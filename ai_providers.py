@@ -1,105 +1,1060 @@
 from abc import ABC, abstractmethod
-from openai import OpenAI
-import google.generativeai as genai
-from ibm_watson import AssistantV2
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+import asyncio
+import atexit
+import functools
+import hashlib
+import json
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+from cachetools import LRUCache
+
+class _LoopLocal:
+    # Async clients are bound to the event loop they were created on, so keep
+    # one per loop. The values hold a reference to their loop, so entries
+    # must be evicted explicitly: clients are closed while asyncio.run()
+    # shuts its loop down (see _close_at_shutdown), and entries of loops
+    # that have since closed are dropped on the next get().
+    def __init__(self, factory):
+        self._factory = factory
+        self._values = {}  # loop -> (value, closer or None)
+        self._lock = threading.Lock()
+
+    def get(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            for stale in [l for l in self._values if l.is_closed()]:
+                _, closer = self._values.pop(stale)
+                if closer is not None:
+                    _finish(closer.aclose())
+            entry = self._values.get(loop)
+            if entry is None:
+                value = self._factory()
+                close = getattr(value, 'aclose', None) or getattr(value, 'close', None)
+                closer = None
+                if close is not None:
+                    closer = _close_at_shutdown(loop, close)
+                    _finish(closer.__anext__())
+                entry = self._values[loop] = (value, closer)
+            return entry[0]
+
+    async def aclose(self):
+        # Close the client opened on the running loop, if any; values without
+        # a close method (limiters, conditions) are just dropped
+        with self._lock:
+            _, closer = self._values.pop(asyncio.get_running_loop(), (None, None))
+        if closer is not None:
+            await closer.aclose()
+
+async def _close_at_shutdown(loop, close):
+    # Parked at the yield once started. asyncio.run() finalizes live async
+    # generators before closing the loop, which runs close() on that loop.
+    try:
+        yield
+    finally:
+        if not loop.is_closed():
+            await close()
+
+def _finish(awaitable):
+    # Step an awaitable that completes without suspending
+    try:
+        awaitable.send(None)
+    except StopIteration:
+        pass
+
+# Read timeouts in seconds; the connect phase is capped separately so an
+# unreachable host fails fast
+DEFAULT_TIMEOUT = 30.0
+CHAT_TIMEOUT = 15.0
+BATCH_TIMEOUT = 60.0
+CONNECT_TIMEOUT = 5
+
+_background_loop = None
+_background_lock = threading.Lock()
+
+def _get_background_loop():
+    # One long-lived loop in a daemon thread for the sync wrappers, so
+    # loop-bound clients (aiohttp sessions, Gemini's gRPC channel, rate
+    # limiters) live as long as their provider rather than one call
+    global _background_loop
+    with _background_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name="ai-providers-loop", daemon=True).start()
+        return _background_loop
+
+def _run_sync(coro):
+    loop = _get_background_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        coro.close()
+        raise RuntimeError("sync provider call made from the background event loop")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+def _close_background(local):
+    # Close what a _LoopLocal holds for the background loop, e.g. at exit
+    if _background_loop is not None and _background_loop.is_running():
+        asyncio.run_coroutine_threadsafe(local.aclose(), _background_loop).result(timeout=CONNECT_TIMEOUT)
+
+class _TokenBucket:
+    # Paces estimated tokens per minute. The level lives on the monotonic
+    # clock so it carries over between event loops; only the Condition used
+    # to queue waiters is per loop.
+    def __init__(self, tokens_per_minute):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self._tokens = tokens_per_minute
+        self._updated = time.monotonic()
+        self._cond = _LoopLocal(asyncio.Condition)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens):
+        tokens = min(tokens, self.capacity)
+        cond = self._cond.get()
+        async with cond:
+            while True:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                try:
+                    await asyncio.wait_for(cond.wait(), (tokens - self._tokens) / self.rate)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def adjust(self, tokens):
+        # Correct the estimate once real usage is known; positive gives tokens
+        # back, negative records the overshoot as debt
+        cond = self._cond.get()
+        async with cond:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + tokens)
+            if tokens > 0:
+                cond.notify_all()
+
+def _make_http_session(headers=None):
+    # Pooled keep-alive session so repeated turns skip the TCP/TLS handshake.
+    # POST is retried too: text generation has no side effects. Read timeouts
+    # are not, so a slow backend fails after one timeout rather than four.
+    retry = Retry(
+        total=3,
+        read=0,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset({"POST"})
+    )
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+def _failover_errors():
+    # Errors meaning the backend is slow or unreachable, so FailoverChain
+    # should move on to the next provider. SDKs are imported lazily, and only
+    # an SDK that has been loaded can raise its own exception types.
+    errors = [
+        TimeoutError,
+        asyncio.TimeoutError,
+        requests.exceptions.Timeout,
+        requests.exceptions.ConnectionError,
+    ]
+    if 'openai' in sys.modules:
+        errors.append(sys.modules['openai'].APIConnectionError)
+    if 'aiohttp' in sys.modules:
+        errors.append(sys.modules['aiohttp'].ClientConnectionError)
+    if 'google.api_core.exceptions' in sys.modules:
+        errors.append(sys.modules['google.api_core.exceptions'].DeadlineExceeded)
+    return tuple(errors)
 
 class AIProvider(ABC):
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+
     @abstractmethod
     def get_completion(self, messages):
         pass
 
+    @abstractmethod
+    async def aget_completion(self, messages):
+        pass
+
+    async def aget_completions(self, batch):
+        # Fan the batch out concurrently, capped at max_concurrency when the
+        # provider (or the provider behind a wrapper) sets one
+        limit = getattr(self, 'max_concurrency', None)
+        if limit is None:
+            return await asyncio.gather(*[self.aget_completion(m) for m in batch])
+        sem = asyncio.Semaphore(limit)
+
+        async def run(messages):
+            async with sem:
+                return await self.aget_completion(messages)
+
+        return await asyncio.gather(*[run(m) for m in batch])
+
+    def get_completions(self, batch):
+        return _run_sync(self.aget_completions(batch))
+
+    def stream_completion(self, messages):
+        # Providers without a streaming API yield the whole reply at once
+        yield self.get_completion(messages)
+
+    def reset(self):
+        # Drop any conversation state kept by the provider
+        pass
+
+    async def aclose(self):
+        # Release async clients before the event loop shuts down
+        pass
+
+    def _new_aiohttp_session(self, headers=None):
+        import aiohttp
+
+        return aiohttp.ClientSession(
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout, connect=CONNECT_TIMEOUT)
+        )
+
 class OpenAIProvider(AIProvider):
-    def __init__(self, api_key):
-        self.client = OpenAI(api_key=api_key)
+    def __init__(self, api_key, timeout=DEFAULT_TIMEOUT, requests_per_minute=500, tokens_per_minute=200000):
+        # SDKs are imported on first use so picking one provider doesn't pay
+        # for loading all the others
+        from openai import OpenAI, AsyncOpenAI, DefaultAioHttpClient
+        from aiolimiter import AsyncLimiter
+
+        super().__init__(timeout)
+        self.client = OpenAI(api_key=api_key, timeout=self.timeout, max_retries=2)
+        # aiohttp transport: the default httpx one degrades to near-serial
+        # throughput under many concurrent requests
+        self._aclient = _LoopLocal(lambda: AsyncOpenAI(
+            api_key=api_key,
+            timeout=self.timeout,
+            max_retries=2,
+            http_client=DefaultAioHttpClient()
+        ))
         self.model = "gpt-4o-mini-2024-07-18"
+        self.temperature = 0
+        # In-flight cap for batches, keeps bursts near the 500 QPM tier limit
+        self.max_concurrency = 50
+        # Pace async dispatch to the tier's QPM/TPM instead of bursting into
+        # 429s and retry backoff
+        self._limiter = _LoopLocal(lambda: AsyncLimiter(max_rate=requests_per_minute, time_period=60))
+        self._token_bucket = _TokenBucket(tokens_per_minute)
+        atexit.register(self.close)
 
     def get_completion(self, messages):
         response = self.client.chat.completions.create(
             model=self.model,
             messages=messages,
-            temperature=0,
+            temperature=self.temperature,
+        )
+        return response.choices[0].message.content
+
+    def stream_completion(self, messages):
+        stream = self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+            stream=True,
         )
+        for chunk in stream:
+            if chunk.choices:
+                yield chunk.choices[0].delta.content or ''
+
+    async def aget_completion(self, messages):
+        # Rough input estimate (~4 characters per token)
+        estimate = len(str(messages)) // 4
+        await self._token_bucket.acquire(estimate)
+        async with self._limiter.get():
+            response = await self._aclient.get().chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=self.temperature,
+            )
+        if response.usage is not None:
+            await self._token_bucket.adjust(estimate - response.usage.total_tokens)
         return response.choices[0].message.content
 
+    @property
+    def cache_namespace(self):
+        return f"openai/{self.model}"
+
+    def close(self):
+        self.client.close()
+        _close_background(self._aclient)
+
+    async def aclose(self):
+        await self._aclient.aclose()
+
 class GeminiProvider(AIProvider):
-    def __init__(self, api_key):
+    def __init__(self, api_key, timeout=DEFAULT_TIMEOUT):
+        import google.generativeai as genai
+
+        super().__init__(timeout)
         genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-pro')
+        # Greedy decoding, so replies are repeatable and safe to cache
+        self.temperature = 0
+        self.model = genai.GenerativeModel('gemini-pro', generation_config={"temperature": self.temperature})
+        # The chat session keeps the history, so each turn only sends the
+        # newest user message instead of replaying the whole chat
+        self.chat = self.model.start_chat(history=[])
+        self._history = []  # messages self.chat currently holds
+        self._busy = False  # a turn is in flight on self.chat
+        self._chat_lock = threading.Lock()
+
+    @contextmanager
+    def _chat_for(self, messages):
+        # Reuse the live session when it already holds messages[:-1]; otherwise
+        # (edited, trimmed or cached history) rebuild it from the history in a
+        # single start_chat. The lock only covers claiming the session, not
+        # the request: a caller arriving mid-turn gets a throwaway chat rather
+        # than interleaving turns in the shared one.
+        history = messages[:-1]
+        with self._chat_lock:
+            shared = not self._busy
+            if shared:
+                if history != self._history:
+                    self.chat = self.model.start_chat(history=self._to_history(history))
+                self._history = None  # unknown until the turn succeeds
+                self._busy = True
+                chat = self.chat
+        if not shared:
+            yield self.model.start_chat(history=self._to_history(history))
+            return
+        history_after = None
+        try:
+            yield chat
+            history_after = list(messages) + [{"role": "assistant", "content": chat.last.text}]
+        finally:
+            with self._chat_lock:
+                # reset() may have swapped in a fresh session meanwhile
+                if self.chat is chat:
+                    self._history = history_after
+                    self._busy = False
 
     def get_completion(self, messages):
+        with self._chat_for(messages) as chat:
+            response = chat.send_message(
+                messages[-1]["content"],
+                request_options={"timeout": self.timeout}
+            )
+        return response.text
+
+    def stream_completion(self, messages):
+        with self._chat_for(messages) as chat:
+            response = chat.send_message(
+                messages[-1]["content"],
+                stream=True,
+                request_options={"timeout": self.timeout}
+            )
+            for chunk in response:
+                yield chunk.text
+
+    async def aget_completion(self, messages):
+        with self._chat_for(messages) as chat:
+            response = await chat.send_message_async(
+                messages[-1]["content"],
+                request_options={"timeout": self.timeout}
+            )
+        return response.text
+
+    async def aget_completions(self, batch):
+        # Batch entries are separate conversations, so each gets a chat built
+        # from its own history instead of going through self.chat
+        async def run(messages):
+            chat = self.model.start_chat(history=self._to_history(messages[:-1]))
+            response = await chat.send_message_async(
+                messages[-1]["content"],
+                request_options={"timeout": self.timeout}
+            )
+            return response.text
+
+        return await asyncio.gather(*[run(m) for m in batch])
+
+    @property
+    def cache_namespace(self):
+        return f"gemini/{self.model.model_name}"
+
+    @staticmethod
+    def _to_history(messages):
         # Convert message history to Gemini format
-        chat = self.model.start_chat()
-        for message in messages:
-            if message["role"] == "user":
-                chat.send_message(message["content"])
-        response = chat.last.text
-        return response
+        return [
+            {"role": "user" if m["role"] == "user" else "model", "parts": [m["content"]]}
+            for m in messages
+        ]
+
+    def reset(self):
+        # Doesn't wait for a turn in flight: it finishes on the old session
+        # and the next call starts from the fresh one
+        with self._chat_lock:
+            self.chat = self.model.start_chat(history=[])
+            self._history = []
+            self._busy = False
 
 class WatsonProvider(AIProvider):
-    def __init__(self, api_key, assistant_id, service_url):
+    # Watson drops sessions after ~5 minutes of inactivity; renew a bit earlier
+    SESSION_TTL = 240
+    # Replies depend on the assistant's dialog state, not just the messages
+    # sent, so they must not be served from a response cache
+    cacheable = False
+
+    def __init__(self, api_key, assistant_id, service_url, timeout=DEFAULT_TIMEOUT):
+        from ibm_watson import AssistantV2
+        from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+
+        super().__init__(timeout)
         authenticator = IAMAuthenticator(api_key)
         self.assistant = AssistantV2(
             version='2021-11-27',
             authenticator=authenticator
         )
         self.assistant.set_service_url(service_url)
+        self.assistant.set_http_config({'timeout': (CONNECT_TIMEOUT, self.timeout)})
         self.assistant_id = assistant_id
+        self._session_id = None
+        self._session_expires_at = 0
+        self._session_lock = threading.Lock()
 
-    def get_completion(self, messages):
-        session = self.assistant.create_session(
-            assistant_id=self.assistant_id
-        ).get_result()
-        
-        response = self.assistant.message(
+    def _get_session(self):
+        with self._session_lock:
+            if self._session_id is None or time.time() >= self._session_expires_at:
+                session = self.assistant.create_session(
+                    assistant_id=self.assistant_id
+                ).get_result()
+                self._session_id = session['session_id']
+            self._session_expires_at = time.time() + self.SESSION_TTL
+            return self._session_id
+
+    def _invalidate_session(self):
+        with self._session_lock:
+            self._session_id = None
+
+    def _send(self, messages):
+        return self.assistant.message(
             assistant_id=self.assistant_id,
-            session_id=session['session_id'],
+            session_id=self._get_session(),
             input={'text': messages[-1]['content']}
         ).get_result()
+
+    def get_completion(self, messages):
+        from ibm_cloud_sdk_core import ApiException
+
+        try:
+            response = self._send(messages)
+        except ApiException as e:
+            if e.code != 404:
+                raise
+            # Session expired server-side; start a new one and retry once
+            self._invalidate_session()
+            response = self._send(messages)
         
         return response['output']['generic'][0]['text']
 
+    async def aget_completion(self, messages):
+        # The Watson SDK is built on requests and has no async client
+        return await asyncio.to_thread(self.get_completion, messages)
+
+    def reset(self):
+        self._invalidate_session()
+
 class DeepAIProvider(AIProvider):
-    def __init__(self, api_key):
+    URL = "https://api.deepai.org/api/text-generator"
+
+    def __init__(self, api_key, timeout=DEFAULT_TIMEOUT):
+        super().__init__(timeout)
         self.api_key = api_key
         self.headers = {'api-key': api_key}
+        self._session = _make_http_session(self.headers)
+        self._aiohttp = _LoopLocal(lambda: self._new_aiohttp_session(self.headers))
+        atexit.register(self.close)
 
     def get_completion(self, messages):
-        response = requests.post(
-            "https://api.deepai.org/api/text-generator",
+        response = self._session.post(
+            self.URL,
             data={'text': messages[-1]['content']},
-            headers=self.headers
+            timeout=(CONNECT_TIMEOUT, self.timeout)
         )
-        return response.json()['output']
+        return orjson.loads(response.content)['output']
+
+    async def aget_completion(self, messages):
+        async with self._aiohttp.get().post(
+            self.URL,
+            data={'text': messages[-1]['content']}
+        ) as response:
+            return orjson.loads(await response.read())['output']
+
+    @property
+    def cache_namespace(self):
+        return self.URL
+
+    def close(self):
+        self._session.close()
+        _close_background(self._aiohttp)
+
+    async def aclose(self):
+        await self._aiohttp.aclose()
+
+class MicroBatcher:
+    # Coalesces calls arriving from different threads (e.g. Streamlit tabs
+    # sharing one provider) within `interval` seconds into a single batched
+    # request of at most max_batch_size prompts
+    def __init__(self, batch_fn, interval=0.01, max_batch_size=10):
+        self.batch_fn = batch_fn
+        self.interval = interval
+        self.max_batch_size = max_batch_size
+        self._pending = []  # (messages, Future)
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def submit(self, messages):
+        future = Future()
+        with self._lock:
+            self._pending.append((messages, future))
+            if len(self._pending) >= self.max_batch_size:
+                batch = self._take()
+            else:
+                batch = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self.interval, self._flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if batch:
+            self._run(batch)
+        return future.result()
+
+    def _take(self):
+        batch, self._pending = self._pending, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _flush(self):
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._run(batch)
+
+    def _run(self, batch):
+        try:
+            responses = self.batch_fn([messages for messages, _ in batch])
+            if len(responses) != len(batch):
+                raise RuntimeError(f"batch of {len(batch)} prompts returned {len(responses)} responses")
+        except Exception as e:
+            # Fail every caller rather than leave some blocked on result()
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), response in zip(batch, responses):
+            future.set_result(response)
 
 class ClarifaiProvider(AIProvider):
-    def __init__(self, api_key, user_id, app_id, model_id):
+    # Most inputs Clarifai accepts in one /outputs request
+    MAX_BATCH = 32
+
+    def __init__(self, api_key, user_id, app_id, model_id, timeout=DEFAULT_TIMEOUT, batch_interval=None):
+        super().__init__(timeout)
         self.api_key = api_key
         self.user_id = user_id
         self.app_id = app_id
         self.model_id = model_id
-
-    def get_completion(self, messages):
-        headers = {
+        # Fixed for the provider's lifetime, so build them once
+        self._url = f"https://api.clarifai.com/v2/users/{self.user_id}/apps/{self.app_id}/models/{self.model_id}/outputs"
+        self._headers = {
             'Authorization': f'Key {self.api_key}',
             'Content-Type': 'application/json'
         }
-        url = f"https://api.clarifai.com/v2/users/{self.user_id}/apps/{self.app_id}/models/{self.model_id}/outputs"
-        
-        response = requests.post(
-            url,
-            headers=headers,
-            json={
-                "inputs": [
-                    {
-                        "data": {
-                            "text": {
-                                "raw": messages[-1]['content']
-                            }
-                        }
-                    }
-                ]
-            }
+        self._session = _make_http_session(self._headers)
+        self._aiohttp = _LoopLocal(lambda: self._new_aiohttp_session(self._headers))
+        # Opt-in: coalesce concurrent single-prompt calls into one request
+        self._batcher = MicroBatcher(self._post_batch, interval=batch_interval) if batch_interval else None
+        atexit.register(self.close)
+
+    @staticmethod
+    def _body(batch):
+        # One input per conversation; pre-serialized with orjson, several
+        # times faster than stdlib json
+        return orjson.dumps({
+            "inputs": [{"data": {"text": {"raw": m[-1]['content']}}} for m in batch]
+        })
+
+    @staticmethod
+    def _chunks(batch):
+        return [batch[i:i + ClarifaiProvider.MAX_BATCH] for i in range(0, len(batch), ClarifaiProvider.MAX_BATCH)]
+
+    def _post_batch(self, batch):
+        response = self._session.post(
+            self._url,
+            data=self._body(batch),
+            timeout=(CONNECT_TIMEOUT, self.timeout)
+        )
+        # Outputs come back in the same order as the inputs
+        return [output['data']['text']['raw'] for output in orjson.loads(response.content)['outputs']]
+
+    async def _apost_batch(self, batch):
+        async with self._aiohttp.get().post(self._url, data=self._body(batch)) as response:
+            return [output['data']['text']['raw'] for output in orjson.loads(await response.read())['outputs']]
+
+    def get_completion(self, messages):
+        if self._batcher is not None:
+            return self._batcher.submit(messages)
+        return self._post_batch([messages])[0]
+
+    async def aget_completion(self, messages):
+        return (await self._apost_batch([messages]))[0]
+
+    def get_completions(self, batch):
+        # N prompts in ceil(N / MAX_BATCH) requests instead of N
+        responses = []
+        for chunk in self._chunks(batch):
+            responses.extend(self._post_batch(chunk))
+        return responses
+
+    @property
+    def cache_namespace(self):
+        return self._url
+
+    async def aget_completions(self, batch):
+        results = await asyncio.gather(*[self._apost_batch(chunk) for chunk in self._chunks(batch)])
+        return [response for chunk in results for response in chunk]
+
+    def close(self):
+        self._session.close()
+        _close_background(self._aiohttp)
+
+    async def aclose(self):
+        await self._aiohttp.aclose()
+
+class FailoverChain(AIProvider):
+    # Tries each provider in order, moving on when one times out or is
+    # unreachable; any other error is raised straight away
+    def __init__(self, providers):
+        self.providers = list(providers)
+        # A reply may come from any provider in the chain
+        self.cacheable = all(getattr(p, 'cacheable', True) for p in self.providers)
+        self.cache_namespace = "|".join(
+            getattr(p, 'cache_namespace', type(p).__name__) for p in self.providers
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.providers[0], name)
+
+    @property
+    def temperature(self):
+        # Deterministic only if whichever provider answers is
+        temperatures = {getattr(p, 'temperature', None) for p in self.providers}
+        return temperatures.pop() if len(temperatures) == 1 else None
+
+    def reset(self):
+        for provider in self.providers:
+            provider.reset()
+
+    async def aclose(self):
+        for provider in self.providers:
+            await provider.aclose()
+
+    def get_completion(self, messages):
+        for provider in self.providers[:-1]:
+            try:
+                return provider.get_completion(messages)
+            except _failover_errors():
+                continue
+        return self.providers[-1].get_completion(messages)
+
+    def stream_completion(self, messages):
+        # Fail over only before the first chunk; a reply can't be spliced
+        # from two providers
+        for provider in self.providers[:-1]:
+            started = False
+            try:
+                for chunk in provider.stream_completion(messages):
+                    started = True
+                    yield chunk
+                return
+            except _failover_errors():
+                if started:
+                    raise
+        yield from self.providers[-1].stream_completion(messages)
+
+    async def aget_completion(self, messages):
+        for provider in self.providers[:-1]:
+            try:
+                return await provider.aget_completion(messages)
+            except _failover_errors():
+                continue
+        return await self.providers[-1].aget_completion(messages)
+
+    async def aget_completions(self, batch):
+        for provider in self.providers[:-1]:
+            try:
+                return await provider.aget_completions(batch)
+            except _failover_errors():
+                continue
+        return await self.providers[-1].aget_completions(batch)
+
+class MemoryCacheBackend:
+    # In-process LRU; entries carry their own expiry since LRUCache has no TTL
+    def __init__(self, maxsize=1024):
+        self._cache = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and time.monotonic() >= expires_at:
+                del self._cache[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._cache[key] = (expires_at, value)
+
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aset(self, key, value, ttl=None):
+        self.set(key, value, ttl)
+
+class RedisCacheBackend:
+    # Shared cache across processes; needs the optional redis package
+    def __init__(self, url="redis://localhost:6379/0", prefix="llm:"):
+        import redis
+        import redis.asyncio
+
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+        self._aclient = _LoopLocal(lambda: redis.asyncio.Redis.from_url(url, decode_responses=True))
+
+    def get(self, key):
+        return self._client.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self._client.set(self.prefix + key, value, ex=ttl)
+
+    async def aget(self, key):
+        return await self._aclient.get().get(self.prefix + key)
+
+    async def aset(self, key, value, ttl=None):
+        await self._aclient.get().set(self.prefix + key, value, ex=ttl)
+
+class LLMCache:
+    def __init__(self, backend=None, ttl=3600):
+        self.backend = backend if backend is not None else MemoryCacheBackend()
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def cache_key(model, messages, temperature):
+        payload = json.dumps(
+            {"model": model, "messages": messages, "temperature": temperature},
+            sort_keys=True
         )
-        return response.json()['outputs'][0]['data']['text']['raw'] 
\ No newline at end of file
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _record(self, value):
+        self.stats["hits" if value is not None else "misses"] += 1
+        return value
+
+    def get(self, key):
+        return self._record(self.backend.get(key))
+
+    def set(self, key, value):
+        self.backend.set(key, value, ttl=self.ttl)
+
+    async def aget(self, key):
+        return self._record(await self.backend.aget(key))
+
+    async def aset(self, key, value):
+        await self.backend.aset(key, value, ttl=self.ttl)
+
+class CachedProvider(AIProvider):
+    # Exact-match response cache in front of any provider. Only providers
+    # that declare temperature == 0 are cached; sampling ones (no temperature
+    # attribute, or temperature > 0) and ones marked cacheable = False are
+    # passed straight through. Keys are namespaced by the provider's
+    # cache_namespace (model, endpoint, ...).
+    def __init__(self, provider, cache=None):
+        self.provider = provider
+        self.cache = cache if cache is not None else LLMCache()
+
+    def __getattr__(self, name):
+        return getattr(self.provider, name)
+
+    def reset(self):
+        self.provider.reset()
+
+    async def aclose(self):
+        await self.provider.aclose()
+
+    def _key(self, messages):
+        if not getattr(self.provider, 'cacheable', True):
+            return None
+        temperature = getattr(self.provider, 'temperature', None)
+        if temperature != 0:
+            return None
+        namespace = getattr(self.provider, 'cache_namespace', type(self.provider).__name__)
+        return self.cache.cache_key(namespace, messages, temperature)
+
+    def get_completion(self, messages):
+        key = self._key(messages)
+        if key is None:
+            return self.provider.get_completion(messages)
+        response = self.cache.get(key)
+        if response is None:
+            response = self.provider.get_completion(messages)
+            self.cache.set(key, response)
+        return response
+
+    def stream_completion(self, messages):
+        key = self._key(messages)
+        response = self.cache.get(key) if key is not None else None
+        if response is not None:
+            yield response
+            return
+        chunks = []
+        for chunk in self.provider.stream_completion(messages):
+            chunks.append(chunk)
+            yield chunk
+        if key is not None:
+            self.cache.set(key, ''.join(chunks))
+
+    async def aget_completion(self, messages):
+        key = self._key(messages)
+        if key is None:
+            return await self.provider.aget_completion(messages)
+        response = await self.cache.aget(key)
+        if response is None:
+            response = await self.provider.aget_completion(messages)
+            await self.cache.aset(key, response)
+        return response
+
+    async def aget_completions(self, batch):
+        # Serve hits from the cache and send only the misses, as one batch
+        keys = [self._key(m) for m in batch]
+        responses = [await self.cache.aget(k) if k is not None else None for k in keys]
+        misses = [i for i, response in enumerate(responses) if response is None]
+        if misses:
+            fresh = await self.provider.aget_completions([batch[i] for i in misses])
+            for i, response in zip(misses, fresh):
+                responses[i] = response
+                if keys[i] is not None:
+                    await self.cache.aset(keys[i], response)
+        return responses
+
+class OpenAIEmbedder:
+    def __init__(self, api_key, model="text-embedding-3-small"):
+        from openai import OpenAI, AsyncOpenAI, DefaultAioHttpClient
+
+        self.client = OpenAI(api_key=api_key)
+        self._aclient = _LoopLocal(lambda: AsyncOpenAI(
+            api_key=api_key,
+            http_client=DefaultAioHttpClient()
+        ))
+        self.model = model
+
+    def embed(self, text):
+        response = self.client.embeddings.create(model=self.model, input=text)
+        return response.data[0].embedding
+
+    async def aembed(self, text):
+        response = await self._aclient.get().embeddings.create(model=self.model, input=text)
+        return response.data[0].embedding
+
+class SentenceTransformerEmbedder:
+    # Offline alternative to OpenAIEmbedder; needs sentence-transformers
+    def __init__(self, model="sentence-transformers/all-MiniLM-L6-v2"):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model)
+
+    def embed(self, text):
+        return self.model.encode(text)
+
+    async def aembed(self, text):
+        return await asyncio.to_thread(self.embed, text)
+
+class SemanticCache(AIProvider):
+    # Near-duplicate cache: reuses the response of an earlier prompt whose
+    # embedding is close enough to the new one, but only within the same
+    # preceding conversation so replies never leak across contexts.
+    # Meant to sit below CachedProvider; needs faiss and numpy.
+    def __init__(self, provider, embedder, threshold=0.92, max_entries=10000, search_k=8):
+        import faiss
+
+        self.provider = provider
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.search_k = search_k
+        self.stats = {"hits": 0, "misses": 0}
+        self._faiss = faiss
+        self._index = None  # created on first insert, once the dimension is known
+        self._entries = []  # (prefix_key, response), aligned with index positions
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.provider, name)
+
+    def reset(self):
+        self.provider.reset()
+
+    async def aclose(self):
+        await self.provider.aclose()
+
+    @staticmethod
+    def _prefix_key(messages):
+        return hashlib.sha256(json.dumps(messages[:-1], sort_keys=True).encode()).hexdigest()
+
+    def _normalize(self, embedding):
+        import numpy as np
+
+        vector = np.asarray(embedding, dtype='float32').reshape(1, -1)
+        # Unit length so inner product == cosine similarity
+        self._faiss.normalize_L2(vector)
+        return vector
+
+    def _lookup(self, prefix_key, vector):
+        with self._lock:
+            if self._index is None or self._index.ntotal == 0:
+                return None
+            k = min(self.search_k, self._index.ntotal)
+            scores, ids = self._index.search(vector, k)
+            for score, i in zip(scores[0], ids[0]):
+                if score < self.threshold:
+                    break
+                if self._entries[i][0] == prefix_key:
+                    return self._entries[i][1]
+        return None
+
+    def _insert(self, prefix_key, vector, response):
+        import numpy as np
+
+        with self._lock:
+            if self._index is None:
+                self._index = self._faiss.IndexFlatIP(vector.shape[1])
+            if self._index.ntotal >= self.max_entries:
+                # FIFO eviction; IndexFlat compacts ids, keeping _entries aligned
+                self._index.remove_ids(np.arange(1, dtype='int64'))
+                self._entries.pop(0)
+            self._index.add(vector)
+            self._entries.append((prefix_key, response))
+
+    def _record(self, value):
+        self.stats["hits" if value is not None else "misses"] += 1
+        return value
+
+    def get_completion(self, messages):
+        if messages[-1]["role"] != "user":
+            return self.provider.get_completion(messages)
+        prefix_key = self._prefix_key(messages)
+        vector = self._normalize(self.embedder.embed(messages[-1]['content']))
+        response = self._record(self._lookup(prefix_key, vector))
+        if response is None:
+            response = self.provider.get_completion(messages)
+            self._insert(prefix_key, vector, response)
+        return response
+
+    def stream_completion(self, messages):
+        if messages[-1]["role"] != "user":
+            yield from self.provider.stream_completion(messages)
+            return
+        prefix_key = self._prefix_key(messages)
+        vector = self._normalize(self.embedder.embed(messages[-1]['content']))
+        response = self._record(self._lookup(prefix_key, vector))
+        if response is not None:
+            yield response
+            return
+        chunks = []
+        for chunk in self.provider.stream_completion(messages):
+            chunks.append(chunk)
+            yield chunk
+        self._insert(prefix_key, vector, ''.join(chunks))
+
+    async def aget_completion(self, messages):
+        if messages[-1]["role"] != "user":
+            return await self.provider.aget_completion(messages)
+        prefix_key = self._prefix_key(messages)
+        vector = self._normalize(await self.embedder.aembed(messages[-1]['content']))
+        response = self._record(self._lookup(prefix_key, vector))
+        if response is None:
+            response = await self.provider.aget_completion(messages)
+            self._insert(prefix_key, vector, response)
+        return response
+
+    async def aget_completions(self, batch):
+        entries = []
+        for messages in batch:
+            if messages[-1]["role"] != "user":
+                entries.append((None, None, None))
+                continue
+            prefix_key = self._prefix_key(messages)
+            vector = self._normalize(await self.embedder.aembed(messages[-1]['content']))
+            entries.append((prefix_key, vector, self._record(self._lookup(prefix_key, vector))))
+        responses = [response for _, _, response in entries]
+        misses = [i for i, response in enumerate(responses) if response is None]
+        if misses:
+            fresh = await self.provider.aget_completions([batch[i] for i in misses])
+            for i, response in zip(misses, fresh):
+                responses[i] = response
+                prefix_key, vector, _ = entries[i]
+                if vector is not None:
+                    self._insert(prefix_key, vector, response)
+        return responses
+
+@functools.lru_cache(maxsize=None)
+def _token_counter(model):
+    # Falls back to ~4 characters per token when tiktoken is missing or its
+    # encoding can't be fetched (first use downloads it), so trimming never
+    # fails a turn
+    try:
+        import tiktoken
+
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return lambda text: len(text) // 4
+    # encode() rejects text containing special tokens such as "<|endoftext|>"
+    return lambda text: len(encoding.encode_ordinary(text))
+
+def trim_history(history, max_tokens=4000, model="gpt-4o-mini"):
+    # Sliding window: keep the newest messages that fit in max_tokens, plus
+    # any system prompt, so every request ships a bounded history. The newest
+    # message is always kept, and the window never opens on an assistant turn.
+    count = _token_counter(model)
+    system = [m for m in history if m["role"] == "system"]
+    budget = max_tokens - sum(count(m["content"]) for m in system)
+    kept = []
+    for message in reversed(history):
+        if message["role"] == "system":
+            continue
+        budget -= count(message["content"])
+        if budget < 0 and kept:
+            break
+        kept.append(message)
+    kept.reverse()
+    while len(kept) > 1 and kept[0]["role"] == "assistant":
+        kept.pop(0)
+    return system + kept
\ No newline at end of file
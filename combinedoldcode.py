@@ -1,110 +1,18 @@
-from abc import ABC, abstractmethod
+import time
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
-from openai import OpenAI
-import google.generativeai as genai
-from ibm_watson import AssistantV2
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-import requests
-
-# AI Provider Classes
-class AIProvider(ABC):
-    @abstractmethod
-    def get_completion(self, messages):
-        pass
-
-class OpenAIProvider(AIProvider):
-    def __init__(self, api_key):
-        self.client = OpenAI(api_key=api_key)
-        self.model = "gpt-4o-mini-2024-07-18"
-
-    def get_completion(self, messages):
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            temperature=0,
-        )
-        return response.choices[0].message.content
-
-class GeminiProvider(AIProvider):
-    def __init__(self, api_key):
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-pro')
-
-    def get_completion(self, messages):
-        # Convert message history to Gemini format
-        chat = self.model.start_chat()
-        for message in messages:
-            if message["role"] == "user":
-                chat.send_message(message["content"])
-        response = chat.last.text
-        return response
-
-class WatsonProvider(AIProvider):
-    def __init__(self, api_key, assistant_id, service_url):
-        authenticator = IAMAuthenticator(api_key)
-        self.assistant = AssistantV2(
-            version='2021-11-27',
-            authenticator=authenticator
-        )
-        self.assistant.set_service_url(service_url)
-        self.assistant_id = assistant_id
-
-    def get_completion(self, messages):
-        session = self.assistant.create_session(
-            assistant_id=self.assistant_id
-        ).get_result()
-        
-        response = self.assistant.message(
-            assistant_id=self.assistant_id,
-            session_id=session['session_id'],
-            input={'text': messages[-1]['content']}
-        ).get_result()
-        
-        return response['output']['generic'][0]['text']
-
-class DeepAIProvider(AIProvider):
-    def __init__(self, api_key):
-        self.api_key = api_key
-        self.headers = {'api-key': api_key}
-
-    def get_completion(self, messages):
-        response = requests.post(
-            "https://api.deepai.org/api/text-generator",
-            data={'text': messages[-1]['content']},
-            headers=self.headers
-        )
-        return response.json()['output']
-
-class ClarifaiProvider(AIProvider):
-    def __init__(self, api_key, user_id, app_id, model_id):
-        self.api_key = api_key
-        self.user_id = user_id
-        self.app_id = app_id
-        self.model_id = model_id
-
-    def get_completion(self, messages):
-        headers = {
-            'Authorization': f'Key {self.api_key}',
-            'Content-Type': 'application/json'
-        }
-        url = f"https://api.clarifai.com/v2/users/{self.user_id}/apps/{self.app_id}/models/{self.model_id}/outputs"
-        
-        response = requests.post(
-            url,
-            headers=headers,
-            json={
-                "inputs": [
-                    {
-                        "data": {
-                            "text": {
-                                "raw": messages[-1]['content']
-                            }
-                        }
-                    }
-                ]
-            }
-        )
-        return response.json()['outputs'][0]['data']['text']['raw']
+from ai_providers import (
+    OpenAIProvider,
+    GeminiProvider,
+    WatsonProvider,
+    DeepAIProvider,
+    ClarifaiProvider,
+    CachedProvider,
+    FailoverChain,
+    CHAT_TIMEOUT,
+    BATCH_TIMEOUT,
+    trim_history
+)
 
 def initialize_session_state():
     """Initialize session state variables"""
@@ -112,6 +20,57 @@ def initialize_session_state():
         st.session_state.conversation_history = []
     if 'ai_provider' not in st.session_state:
         st.session_state.ai_provider = None
+    if 'backup_provider' not in st.session_state:
+        st.session_state.backup_provider = None
+    if 'executor' not in st.session_state:
+        st.session_state.executor = ThreadPoolExecutor(max_workers=4)
+    if 'pending' not in st.session_state:
+        st.session_state.pending = []
+
+# Providers are built once per set of credentials and timeout and shared
+# across reruns and sessions, so their HTTP connection pools (and TLS
+# sessions) survive.
+# Watson is left out, and not cached either: its assistant session carries
+# per-user dialog state. DeepAI and Clarifai sample their replies, so only
+# the temperature-0 OpenAI and Gemini providers get a response cache.
+@st.cache_resource
+def _make_openai(api_key, timeout):
+    return CachedProvider(OpenAIProvider(api_key, timeout=timeout))
+
+@st.cache_resource
+def _make_gemini(api_key, timeout):
+    return CachedProvider(GeminiProvider(api_key, timeout=timeout))
+
+@st.cache_resource
+def _make_deepai(api_key, timeout):
+    return DeepAIProvider(api_key, timeout=timeout)
+
+@st.cache_resource
+def _make_clarifai(api_key, user_id, app_id, model_id, timeout):
+    return ClarifaiProvider(api_key, user_id, app_id, model_id, timeout=timeout, batch_interval=0.01)
+
+def _connect(name, make, as_backup):
+    """Build the chat and batch providers, as the main or the backup provider"""
+    try:
+        # Batches tolerate a longer read timeout than interactive chat turns
+        providers = {"chat": make(CHAT_TIMEOUT), "batch": make(BATCH_TIMEOUT)}
+    except Exception as e:
+        st.error(f"Error connecting to {name}: {str(e)}")
+        return
+    if as_backup:
+        st.session_state.backup_provider = providers
+        st.success(f"Successfully connected to {name} as backup!")
+    else:
+        st.session_state.ai_provider = providers
+        st.success(f"Successfully connected to {name}!")
+
+def _get_provider(kind):
+    """Provider for "chat" or "batch" requests, failing over to the backup"""
+    provider = st.session_state.ai_provider[kind]
+    backup = st.session_state.backup_provider
+    if backup is None:
+        return provider
+    return FailoverChain([provider, backup[kind]])
 
 def setup_ai_provider():
     """Setup AI provider with Streamlit interface"""
@@ -124,43 +83,30 @@ def setup_ai_provider():
     )
     
     with st.sidebar.form("credentials_form"):
+        # The backup takes over when the main provider times out
+        as_backup = st.checkbox("Connect as backup provider")
+        
         if provider_choice == "OpenAI":
             api_key = st.text_input("OpenAI API Key", type="password")
             if st.form_submit_button("Connect"):
-                try:
-                    st.session_state.ai_provider = OpenAIProvider(api_key)
-                    st.success("Successfully connected to OpenAI!")
-                except Exception as e:
-                    st.error(f"Error connecting to OpenAI: {str(e)}")
+                _connect("OpenAI", lambda timeout: _make_openai(api_key, timeout), as_backup)
         
         elif provider_choice == "Google Gemini":
             api_key = st.text_input("Google API Key", type="password")
             if st.form_submit_button("Connect"):
-                try:
-                    st.session_state.ai_provider = GeminiProvider(api_key)
-                    st.success("Successfully connected to Gemini!")
-                except Exception as e:
-                    st.error(f"Error connecting to Gemini: {str(e)}")
+                _connect("Gemini", lambda timeout: _make_gemini(api_key, timeout), as_backup)
         
         elif provider_choice == "IBM Watson":
             api_key = st.text_input("IBM Watson API Key", type="password")
             assistant_id = st.text_input("Assistant ID")
             service_url = st.text_input("Service URL")
             if st.form_submit_button("Connect"):
-                try:
-                    st.session_state.ai_provider = WatsonProvider(api_key, assistant_id, service_url)
-                    st.success("Successfully connected to IBM Watson!")
-                except Exception as e:
-                    st.error(f"Error connecting to IBM Watson: {str(e)}")
+                _connect("IBM Watson", lambda timeout: WatsonProvider(api_key, assistant_id, service_url, timeout=timeout), as_backup)
         
         elif provider_choice == "DeepAI":
             api_key = st.text_input("DeepAI API Key", type="password")
             if st.form_submit_button("Connect"):
-                try:
-                    st.session_state.ai_provider = DeepAIProvider(api_key)
-                    st.success("Successfully connected to DeepAI!")
-                except Exception as e:
-                    st.error(f"Error connecting to DeepAI: {str(e)}")
+                _connect("DeepAI", lambda timeout: _make_deepai(api_key, timeout), as_backup)
         
         elif provider_choice == "Clarifai":
             api_key = st.text_input("Clarifai API Key", type="password")
@@ -168,11 +114,7 @@ def setup_ai_provider():
             app_id = st.text_input("App ID")
             model_id = st.text_input("Model ID")
             if st.form_submit_button("Connect"):
-                try:
-                    st.session_state.ai_provider = ClarifaiProvider(api_key, user_id, app_id, model_id)
-                    st.success("Successfully connected to Clarifai!")
-                except Exception as e:
-                    st.error(f"Error connecting to Clarifai: {str(e)}")
+                _connect("Clarifai", lambda timeout: _make_clarifai(api_key, user_id, app_id, model_id, timeout), as_backup)
 
 def display_conversation():
     """Display the conversation history"""
@@ -182,6 +124,78 @@ def display_conversation():
         else:
             st.write(f"Assistant: {message['content']}")
 
+def _stream_reply(provider, history, chunks):
+    """Stream a reply in a worker thread, collecting chunks as they arrive"""
+    for chunk in provider.stream_completion(history):
+        chunks.append(chunk)
+    return "".join(chunks)
+
+def submit_request(prompts):
+    """Dispatch prompts to the worker pool so the UI stays responsive"""
+    history = st.session_state.conversation_history
+    executor = st.session_state.executor
+    
+    if len(prompts) == 1:
+        # Cap the history so request size stays bounded as the chat grows
+        messages = trim_history(history + [{"role": "user", "content": prompts[0]}])
+        chunks = []
+        future = executor.submit(_stream_reply, _get_provider("chat"), messages, chunks)
+    else:
+        # Several prompts: answer each against the current history in one
+        # concurrent batch
+        history = trim_history(history)
+        batch = [history + [{"role": "user", "content": p}] for p in prompts]
+        chunks = None
+        future = executor.submit(_get_provider("batch").get_completions, batch)
+    
+    st.session_state.pending.append({"prompts": prompts, "future": future, "chunks": chunks})
+
+def collect_pending():
+    """Wait for in-flight requests, then add their replies to the history"""
+    pending = st.session_state.pending
+    if not pending:
+        return
+    
+    placeholders = []
+    for request in pending:
+        for prompt in request["prompts"]:
+            st.write(f"You: {prompt}")
+        placeholders.append(st.empty())
+    
+    # Streamlit only notices a click on the widgets above (and reruns the
+    # script) when the script sends it an update, so every poll writes to
+    # the status line even while no chunks have arrived
+    status = st.empty()
+    started = time.monotonic()
+    with st.spinner("Thinking..."):
+        while True:
+            for request, placeholder in zip(pending, placeholders):
+                if request["chunks"]:
+                    placeholder.write(f"Assistant: {''.join(request['chunks'])}")
+            if all(request["future"].done() for request in pending):
+                break
+            status.caption(f"Waiting for a reply... {time.monotonic() - started:.1f}s")
+            time.sleep(0.1)
+    status.empty()
+    
+    st.session_state.pending = []
+    history = st.session_state.conversation_history
+    failed = False
+    for request in pending:
+        try:
+            result = request["future"].result()
+        except Exception as e:
+            st.error(f"Error: {str(e)}")
+            failed = True
+            continue
+        ai_responses = [result] if request["chunks"] is not None else result
+        for prompt, ai_response in zip(request["prompts"], ai_responses):
+            history.append({"role": "user", "content": prompt})
+            history.append({"role": "assistant", "content": ai_response})
+    
+    if not failed:
+        st.experimental_rerun()
+
 def main():
     st.title("Multi-AI Provider Chat Interface")
     
@@ -197,35 +211,32 @@ def main():
     # Display conversation history
     display_conversation()
     
-    # Chat input
-    user_input = st.text_input("Your message:", key="user_input")
+    # Chat input, one prompt per line
+    user_input = st.text_area("Your message (one prompt per line):", key="user_input")
     
     # Process user input
-    if st.button("Send") and user_input:
+    if st.button("Send") and user_input.strip():
         if st.session_state.ai_provider is None:
             st.error("Please set up an AI provider first!")
             return
-            
-        # Add user message to conversation history
-        st.session_state.conversation_history.append({"role": "user", "content": user_input})
         
-        try:
-            # Get response from AI provider
-            ai_response = st.session_state.ai_provider.get_completion(st.session_state.conversation_history)
-            
-            # Add assistant's response to conversation history
-            st.session_state.conversation_history.append({"role": "assistant", "content": ai_response})
-            
-            # Clear the input box (requires a rerun)
-            st.experimental_rerun()
-            
-        except Exception as e:
-            st.error(f"Error: {str(e)}")
+        prompts = [line.strip() for line in user_input.splitlines() if line.strip()]
+        submit_request(prompts)
     
     # Clear chat button
     if st.button("Clear Chat"):
+        for request in st.session_state.pending:
+            request["future"].cancel()
+        st.session_state.pending = []
         st.session_state.conversation_history = []
+        for providers in (st.session_state.ai_provider, st.session_state.backup_provider):
+            if providers is not None:
+                for provider in providers.values():
+                    provider.reset()
         st.experimental_rerun()
+    
+    # Show progress and pick up replies from the worker threads
+    collect_pending()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
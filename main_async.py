@@ -0,0 +1,35 @@
+import asyncio
+import threading
+
+try:
+    import uvloop
+except ImportError:
+    # uvloop only supports Linux/macOS; fall back to the stdlib event loop
+    uvloop = None
+
+from oldcode import build_chat_provider, chat_loop
+
+def main():
+    # Setup AI provider
+    ai_provider = build_chat_provider()
+    
+    # The REPL blocks on input(), so the async requests run on an event loop
+    # in a background thread
+    loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    
+    def reply(conversation_history):
+        future = asyncio.run_coroutine_threadsafe(ai_provider.aget_completion(conversation_history), loop)
+        ai_response = future.result()
+        print(f"Assistant: {ai_response}")
+        return ai_response
+    
+    try:
+        chat_loop(reply)
+    finally:
+        # Also on EOF or Ctrl-C, so async clients don't leak
+        asyncio.run_coroutine_threadsafe(ai_provider.aclose(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
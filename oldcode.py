@@ -1,12 +1,20 @@
+import sys
 from getpass import getpass
 from ai_providers import (
     OpenAIProvider,
     GeminiProvider,
     WatsonProvider,
     DeepAIProvider,
-    ClarifaiProvider
+    ClarifaiProvider,
+    CachedProvider,
+    FailoverChain,
+    CHAT_TIMEOUT,
+    trim_history
 )
 
+# Phrases that end the conversation, matched after strip() and casefold()
+STOP_PHRASES = frozenset({"thank you", "thanks", "bye", "goodbye", "quit", "exit"})
+
 def setup_ai_provider():
     print("\nAvailable AI Providers:")
     print("1. OpenAI")
@@ -19,39 +27,59 @@ def setup_ai_provider():
     
     if choice == "1":
         api_key = getpass("Enter your OpenAI API Key: ")
-        return OpenAIProvider(api_key)
+        return OpenAIProvider(api_key, timeout=CHAT_TIMEOUT)
     
     elif choice == "2":
         api_key = getpass("Enter your Google API Key: ")
-        return GeminiProvider(api_key)
+        return GeminiProvider(api_key, timeout=CHAT_TIMEOUT)
     
     elif choice == "3":
         api_key = getpass("Enter your IBM Watson API Key: ")
         assistant_id = input("Enter your Assistant ID: ")
         service_url = input("Enter your Service URL: ")
-        return WatsonProvider(api_key, assistant_id, service_url)
+        return WatsonProvider(api_key, assistant_id, service_url, timeout=CHAT_TIMEOUT)
     
     elif choice == "4":
         api_key = getpass("Enter your DeepAI API Key: ")
-        return DeepAIProvider(api_key)
+        return DeepAIProvider(api_key, timeout=CHAT_TIMEOUT)
     
     elif choice == "5":
         api_key = getpass("Enter your Clarifai API Key: ")
         user_id = input("Enter your User ID: ")
         app_id = input("Enter your App ID: ")
         model_id = input("Enter your Model ID: ")
-        return ClarifaiProvider(api_key, user_id, app_id, model_id)
+        return ClarifaiProvider(api_key, user_id, app_id, model_id, timeout=CHAT_TIMEOUT)
     
     else:
         print("Invalid choice. Using OpenAI as default.")
         api_key = getpass("Enter your OpenAI API Key: ")
-        return OpenAIProvider(api_key)
+        return OpenAIProvider(api_key, timeout=CHAT_TIMEOUT)
 
-if __name__ == "__main__":
-    # Setup AI provider
+def build_chat_provider():
     ai_provider = setup_ai_provider()
     
-    # Initialize conversation history
+    # Optionally fall back to a second provider when the first one times out
+    if input("\nConfigure a backup provider for failover? (y/N): ").strip().lower() == "y":
+        ai_provider = FailoverChain([ai_provider, setup_ai_provider()])
+    # Stateful providers (Watson) answer from their own dialog state
+    if not getattr(ai_provider, 'cacheable', True):
+        return ai_provider
+    return CachedProvider(ai_provider)
+
+def stream_reply(ai_provider, conversation_history):
+    # Stream the response from the AI provider as it arrives
+    sys.stdout.write("Assistant: ")
+    chunks = []
+    for token in ai_provider.stream_completion(conversation_history):
+        sys.stdout.write(token)
+        sys.stdout.flush()
+        chunks.append(token)
+    print()
+    return "".join(chunks)
+
+def chat_loop(reply):
+    # Shared REPL; reply(conversation_history) prints the assistant's answer
+    # and returns its text
     conversation_history = []
     
     # Initial instruction
@@ -61,7 +89,7 @@ if __name__ == "__main__":
         prompt = input("\nYou: ")
         
         # Check if user wants to end conversation
-        if prompt.lower() in ["thank you", "thanks"]:
+        if prompt.strip().casefold() in STOP_PHRASES:
             print("Assistant: You're welcome! Goodbye!")
             break
         
@@ -69,15 +97,26 @@ if __name__ == "__main__":
         conversation_history.append({"role": "user", "content": prompt})
         
         try:
-            # Get response from AI provider
-            ai_response = ai_provider.get_completion(conversation_history)
+            # Cap the history so request size stays bounded as the chat grows
+            conversation_history = trim_history(conversation_history)
+            
+            ai_response = reply(conversation_history)
             
             # Add assistant's response to conversation history
             conversation_history.append({"role": "assistant", "content": ai_response})
             
-            print(f"Assistant: {ai_response}")
             print("\n(Continue asking questions or say 'thank you' to end the conversation)")
             
         except Exception as e:
+            # Drop the unanswered message so the history keeps alternating
+            # user/assistant turns (Gemini rejects two user turns in a row)
+            if conversation_history and conversation_history[-1]["role"] == "user":
+                conversation_history.pop()
             print(f"Error: {str(e)}")
-            print("Please try again or say 'thank you' to end the conversation")
\ No newline at end of file
+            print("Please try again or say 'thank you' to end the conversation")
+
+if __name__ == "__main__":
+    # Setup AI provider
+    ai_provider = build_chat_provider()
+    
+    chat_loop(lambda conversation_history: stream_reply(ai_provider, conversation_history))
\ No newline at end of file